@@ -3,10 +3,44 @@ __version__ = ""
 from meshroom.core import desc
 
 import os
+import io
 import csv
-import json
+import mmap
+import locale
 import struct
 import itertools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    # orjson parses large SfMData files several times faster, when it is installed
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+_PACK_Q = struct.Struct('<Q').pack
+_PACK_Q_INTO = struct.Struct('<Q').pack_into
+_DESC_HEADER_SIZE = 8
+_DESCRIPTOR_SIZE = 128
+_EMPTY_DESC_DATA = _PACK_Q(0)
+_WRITE_BUFFER_SIZE = 1 << 16
+_MATCHES_BUFFER_SIZE = 1 << 20
+_MMAP_MIN_SIZE = 1 << 20
+_WRITE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+def _decode_text(data):
+    # AliceVision writes the SfMData as UTF-8, decoding the markers the same way keeps the image names comparable.
+    # Files that are not valid UTF-8 fall back to the locale encoding that open() uses in text mode.
+    try:
+        return str(data, "utf-8-sig")
+    except UnicodeDecodeError:
+        return str(data, locale.getpreferredencoding(False))
+
+def _write_view_files(feat_path, feat_data, desc_path, desc_data):
+    with open(feat_path, "wb", buffering=_WRITE_BUFFER_SIZE) as feat:
+        feat.write(feat_data)
+    with open(desc_path, "wb", buffering=_WRITE_BUFFER_SIZE) as desc:
+        desc.write(desc_data)
 
 class ImportMarkerFeatures(desc.Node):
     category = 'Utils'
@@ -106,18 +140,31 @@ CSV format:
     
     def load_images(self, chunk, filepath, delimiter):
         images = {}
-        csv_data = []
+        count = 0
         
-        with open(filepath) as file:
-            gcp_file = csv.reader(file, delimiter=delimiter)
-            csv_data = [(row[2], row[0], row[1], row[4], int(row[3])) for row in gcp_file]
-
-        images.update({item[0]: [] for item in csv_data})
-
-        for item in csv_data:
-            images[item[0]].append([*item[1:]])
+        with open(filepath, "rb") as file:
+            if os.fstat(file.fileno()).st_size < _MMAP_MIN_SIZE:
+                text = _decode_text(file.read())
+            else:
+                # Decode straight from the mapped file, skipping the intermediate copy made by read()
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    text = _decode_text(mapped)
+        
+        if '"' not in text:
+            # Without quote characters csv.reader splits on the delimiter exactly like str.split, only slower.
+            # Only \r and \n end a line, as they do for csv.reader, str.splitlines would also break on other control characters.
+            lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+            if lines[-1] == "":
+                lines.pop()
+            rows = (line.split(delimiter) for line in lines)
+        else:
+            rows = csv.reader(io.StringIO(text, newline=''), delimiter=delimiter)
         
-        chunk.logger.info("Loaded %d marker matches in %d image(s)" % (len(csv_data), len(images)))
+        for row in rows:
+            images.setdefault(row[2], []).append([row[0], row[1], row[4], int(row[3])])
+            count += 1
+        
+        chunk.logger.info("Loaded %d marker matches in %d image(s)" % (count, len(images)))
             
         return images
     
@@ -125,81 +172,105 @@ CSV format:
         if not os.path.isfile(chunk.node.input.value):
             raise Exception("View data file not found")
         
-        views = []
-        views_lookup = {}
-        with open(chunk.node.input.value) as file:
-            views = json.load(file)["views"]
-        
-        for item in views:
-            views_lookup[os.path.basename(item["path"])] = item["viewId"]
+        basename = os.path.basename
+        with open(chunk.node.input.value, "rb") as file:
+            views_lookup = {basename(item["path"]): item["viewId"] for item in _json_loads(file.read())["views"]}
         
         chunk.logger.info("Found %d view(s)" % len(views_lookup))
         
         return views_lookup
     
     def write_describers(self, chunk, images, lookup):
-        chunk.logger.info("Writing %s descriptor files" % chunk.node.type.value)
+        out_prefix = os.path.join(chunk.node.output.value, "")
+        desc_type = chunk.node.type.value
+        feat_suffix = ".%s.feat" % desc_type
+        desc_suffix = ".%s.desc" % desc_type
+        hack = chunk.node.hack.value
+        update_progress = chunk.logManager.updateProgressBar
+        logger_info = chunk.logger.info
+        
+        logger_info("Writing %s descriptor files" % desc_type)
         chunk.logManager.makeProgressBar(len(lookup))
         
-        found_markers = {i: 0 for i in list(set([marker[3] for img in images for marker in images[img]]))}
-        feature_lookup = {viewid: {} for viewid in lookup.values()} # feature_lookup[viewid][tagid]
+        found_markers = dict.fromkeys((marker[3] for markers in images.values() for marker in markers), 0)
+        tag_views = {} # tag_views[tagid] = ([viewid, ...], [feat_idx, ...]) in view order, only filled for matches.txt
         
-        for i, img in enumerate(lookup):
-            viewid = lookup[img]
-            
-            feat = open(os.path.join(chunk.node.output.value, viewid + (".%s.feat" % chunk.node.type.value)), "w")
-            desc = open(os.path.join(chunk.node.output.value, viewid + (".%s.desc" % chunk.node.type.value)), "wb")
-            
-            if img in images:
-                feat_idx = 0
-                markers = images[img]
-                desc.write(struct.pack('<Q', len(markers)))
-                
-                for marker in markers:
-                    feat_x, feat_y, feat_size, feat_orientation = marker[0], marker[1], marker[2], "0"
-                    tagid = marker[3]
-                    found_markers[tagid] += 1
-                    feat.write(" ".join((feat_x, feat_y, feat_size, feat_orientation + "\n")))
-                    feature_lookup[viewid][tagid] = str(feat_idx)
-                    feat_idx += 1
+        # Each view writes its own pair of files, so the disk writes run concurrently while the next views are built
+        futures = []
+        with ThreadPoolExecutor(max_workers=_WRITE_WORKERS) as executor:
+            try:
+                for img in lookup:
+                    viewid = lookup[img]
+                    
+                    feat_path = out_prefix + viewid + feat_suffix
+                    desc_path = out_prefix + viewid + desc_suffix
+                    feat_lines = []
+                    desc_payload = _EMPTY_DESC_DATA
                     
-                if chunk.node.hack.value is False:
-                    data = bytearray(128)
-                    data[marker[3]] = 255
-                    desc.write(data)
+                    if img in images:
+                        feat_idx = 0
+                        markers = images[img]
+                        if hack is False:
+                            # One 128-byte descriptor per feature, with the byte matching the tag ID set
+                            desc_payload = bytearray(_DESC_HEADER_SIZE + _DESCRIPTOR_SIZE * len(markers))
+                            tag_offset = _DESC_HEADER_SIZE
+                            _PACK_Q_INTO(desc_payload, 0, len(markers))
+                        else:
+                            desc_payload = _PACK_Q(len(markers))
+                        
+                        for feat_x, feat_y, feat_size, tagid in markers:
+                            feat_lines.append(f"{feat_x} {feat_y} {feat_size} 0\n") # Orientation is always 0
+                            if hack is False:
+                                if not 0 <= tagid < _DESCRIPTOR_SIZE:
+                                    raise Exception("Marker ID %d in image %s is outside the 0-%d range, enable \"Bypass 128-Tag Limit\" to import it" % (tagid, img, _DESCRIPTOR_SIZE - 1))
+                                desc_payload[tag_offset + tagid] = 255
+                                tag_offset += _DESCRIPTOR_SIZE
+                            else:
+                                if tagid not in tag_views:
+                                    tag_views[tagid] = ([], [])
+                                tag_viewids, tag_indices = tag_views[tagid]
+                                if tag_viewids and tag_viewids[-1] == viewid:
+                                    # A tag repeated in the same view keeps its last feature, a view must not match itself
+                                    tag_indices[-1] = feat_idx
+                                else:
+                                    tag_viewids.append(viewid)
+                                    tag_indices.append(feat_idx)
+                            feat_idx += 1
+                        
+                        for tagid in {marker[3] for marker in markers}:
+                            found_markers[tagid] += 1
+                        
+                    futures.append(executor.submit(_write_view_files, feat_path, "".join(feat_lines).encode(), desc_path, desc_payload))
                 
-            else:
-                desc.write(struct.pack('<Q', 0))
-            
-            desc.close()
-            feat.close()
-            
-            chunk.logManager.updateProgressBar(i + 1)
-            
-        chunk.logger.info("Markers report:")
-        for marker in found_markers:
-            chunk.logger.info("\tFound marker %d in %d view(s)" % (marker, found_markers[marker]))
+                for i, future in enumerate(as_completed(futures)):
+                    future.result()
+                    update_progress(i + 1)
+            except BaseException:
+                # Stop the queued writes instead of waiting for all of them before reporting the failure
+                for future in futures:
+                    future.cancel()
+                raise
+        
+        logger_info("Markers report:\n" + "\n".join("\tFound marker %d in %d view(s)" % (marker, found_markers[marker]) for marker in sorted(found_markers)))
             
-        return feature_lookup
+        return tag_views
     
-    def make_matches_txt(self, chunk, image_pairs, feature_lookup):
-        out_temp = []
-        for pair in image_pairs:
-            viewid_A, viewid_B = pair
-            tags_detected_A = feature_lookup[viewid_A].keys()
-            tags_detected_B = feature_lookup[viewid_B].keys()
-            match = tags_detected_A & tags_detected_B
-            if match:
-                out_temp.append(" ".join((viewid_A, viewid_B)))
-                out_temp.append("1")
-                out_temp.append(f"{chunk.node.type.value} {len(match)}")
-                for tagid in match:
-                    feature_index_A = feature_lookup[viewid_A][tagid]
-                    feature_index_B = feature_lookup[viewid_B][tagid]
-                    out_temp.append(" ".join((feature_index_A, feature_index_B)))
+    def make_matches_txt(self, chunk, tag_views):
+        # Walking the views that share each tag yields the same pairs as the "Exhaustive" ImageMatching
+        # method, without visiting the view pairs that have no marker in common.
+        pair_matches = defaultdict(list)
+        for viewids, indices in tag_views.values():
+            # Both combinations run in the same order, so the view pairs and index pairs stay aligned
+            for pair, (feature_index_A, feature_index_B) in zip(itertools.combinations(viewids, 2), itertools.combinations(indices, 2)):
+                pair_matches[pair].append((feature_index_A, feature_index_B))
         
-        with open(os.path.join(chunk.node.matches_out.value, "0.matches.txt"), "w") as matches_txt:
-            matches_txt.write("\n".join(out_temp))
+        desc_type = chunk.node.type.value
+        with open(os.path.join(chunk.node.matches_out.value, "0.matches.txt"), "w", buffering=_MATCHES_BUFFER_SIZE) as matches_txt:
+            write = matches_txt.write
+            for (viewid_A, viewid_B), matches in pair_matches.items():
+                write(f"{viewid_A} {viewid_B}\n1\n{desc_type} {len(matches)}\n")
+                for feature_index_A, feature_index_B in matches:
+                    write(f"{feature_index_A} {feature_index_B}\n")
     
     def processChunk(self, chunk):
         delimiters_options = {
@@ -219,11 +290,10 @@ CSV format:
                 raise OSError("Marker features list file not found")
             
             lookup = self.load_viewids(chunk)
-            image_pairs = list(itertools.combinations(lookup.values(), 2)) # This method can produce the same results as the ImageMatching node that uses the "Exhaustive" method.
             images = self.load_images(chunk, chunk.node.matches.value, delimiters_options[chunk.node.delimiter.value])
-            feature_lookup = self.write_describers(chunk, images, lookup)
+            tag_views = self.write_describers(chunk, images, lookup)
             if chunk.node.hack.value:
-                self.make_matches_txt(chunk, image_pairs, feature_lookup)
+                self.make_matches_txt(chunk, tag_views)
             
             chunk.logger.info("Task done")
             